@@ -1,15 +1,21 @@
 # auth.py — Módulo de autenticação revisado (simulador / demo)
 import os
+import time
+import asyncio
+import heapq
 import logging
-import uuid
+import secrets
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any
 
 from fastapi import APIRouter, Depends, HTTPException, status, Body, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr, Field, field_validator
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError as JWTError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,16 +27,65 @@ ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 PASSWORD_RESET_EXPIRE_MINUTES = int(os.getenv("PASSWORD_RESET_EXPIRE_MINUTES", "60"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
 security = HTTPBearer()
+# bcrypt is CPU-bound (and releases the GIL); keep it off the event loop
+_bcrypt_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
 
 # ==== In-memory stores (DEV only) ====
 # users_db keyed by email -> user dict {id,email,password_hash,name,...}
 _users_db: Dict[str, Dict[str, Any]] = {}
-# blacklists store token jti values
-_revoked_jti_access: set[str] = set()
-_revoked_jti_refresh: set[str] = set()
+# users_by_id keyed by user id -> same dict object stored in _users_db
+_users_by_id: Dict[str, Dict[str, Any]] = {}
+
+class TTLRevocationSet:
+    """Blacklist de jti que descarta entradas após o `exp` do token correspondente."""
+
+    def __init__(self) -> None:
+        self._set: set[str] = set()
+        self._heap: list[tuple[float, str]] = []
+
+    def _purge(self) -> None:
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, jti = heapq.heappop(self._heap)
+            self._set.discard(jti)
+
+    def add(self, jti: str, exp_ts: float) -> None:
+        self._purge()
+        if jti not in self._set:
+            self._set.add(jti)
+            heapq.heappush(self._heap, (float(exp_ts), jti))
+
+    def __contains__(self, jti: object) -> bool:
+        self._purge()
+        return jti in self._set
+
+    def __len__(self) -> int:
+        self._purge()
+        return len(self._set)
+
+# blacklists store token jti values until the token would have expired
+_revoked_jti_access = TTLRevocationSet()
+_revoked_jti_refresh = TTLRevocationSet()
 
 # ==== Pydantic models ====
+_SPECIAL_CHARS = frozenset("!@#$%^&*()-_=+[]{};:,.<>/?\\")
+_PW_UPPER, _PW_DIGIT, _PW_SPECIAL = 1, 2, 4
+_PW_ALL = _PW_UPPER | _PW_DIGIT | _PW_SPECIAL
+
+def _password_flags(v: str) -> int:
+    """Bitmask of character classes present in `v` (reusable by bulk import tooling)."""
+    flags = 0 if _SPECIAL_CHARS.isdisjoint(v) else _PW_SPECIAL
+    for c in v:
+        if c.isupper():
+            flags |= _PW_UPPER
+        elif c.isdigit():
+            flags |= _PW_DIGIT
+        if flags == _PW_ALL:
+            break
+    return flags
+
 class TokenResponse(BaseModel):
     access_token: str
     refresh_token: Optional[str] = None
@@ -46,11 +101,12 @@ class UserRegister(BaseModel):
     @field_validator("password")
     @classmethod
     def validate_password(cls, v: str) -> str:
-        if not any(c.isupper() for c in v):
+        flags = _password_flags(v)
+        if not flags & _PW_UPPER:
             raise ValueError("Senha deve conter pelo menos uma letra maiúscula")
-        if not any(c.isdigit() for c in v):
+        if not flags & _PW_DIGIT:
             raise ValueError("Senha deve conter pelo menos um número")
-        if not any(c in "!@#$%^&*()-_=+[]{};:,.<>/?\\" for c in v):
+        if not flags & _PW_SPECIAL:
             raise ValueError("Senha deve conter pelo menos um caractere especial")
         return v
 
@@ -79,23 +135,37 @@ class UserUpdateResponse(BaseModel):
     user: Dict[str, str]
 
 # ==== Utilities ====
+def _password_bytes(password: str) -> bytes:
+    # bcrypt only uses the first 72 bytes; truncating bytes (not str) never re-decodes
+    return password.encode('utf-8')[:72]
+
 def hash_password(password: str) -> str:
-    # Truncar para 72 bytes e fazer hash com bcrypt
-    password_bytes = password.encode('utf-8')[:72]
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password_bytes, salt)
-    return hashed.decode('utf-8')
+    hashed = bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    # bcrypt output is always ASCII
+    return hashed.decode('ascii')
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     try:
-        password_bytes = plain_password.encode('utf-8')[:72]
-        hashed_bytes = hashed_password.encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hashed_bytes)
+        return bcrypt.checkpw(_password_bytes(plain_password), hashed_password.encode('ascii'))
     except Exception:
         return False
 
+async def _hash_password_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_bcrypt_pool, hash_password, password)
+
+async def _verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_bcrypt_pool, verify_password, plain_password, hashed_password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    # bcrypt hashes look like $2b$<rounds>$...; rehash when the cost differs from BCRYPT_ROUNDS
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
 def _make_jti() -> str:
-    return uuid.uuid4().hex
+    # 128 random bits, 22 url-safe chars (no uuid formatting overhead)
+    return secrets.token_urlsafe(16)
 
 def _now_utc() -> datetime:
     return datetime.now(timezone.utc)
@@ -106,11 +176,20 @@ def _encode_jwt(payload: Dict[str, Any], expires_delta: timedelta) -> str:
     to_encode.update({"exp": expire, "iat": _now_utc()})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+@lru_cache(maxsize=4096)
+def _decode_cached(token: str) -> Dict[str, Any]:
+    # Only successful decodes are cached; JWTError propagates and is never stored.
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
 def _decode_jwt(token: str) -> Dict[str, Any]:
     try:
-        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _decode_cached(token)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido ou expirado")
+    # expiry is rechecked on every call since cached payloads may outlive the token
+    if payload.get("exp", 0) <= _now_utc().timestamp():
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido ou expirado")
+    return dict(payload)
 
 def create_access_token(user_id: str, email: str, expires_delta: Optional[timedelta] = None) -> Dict[str, Any]:
     jti = _make_jti()
@@ -155,38 +234,45 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
 
 # ==== Helper to get current user (data dict) ====
 def get_current_user(payload: Dict[str, Any] = Depends(verify_token)) -> Dict[str, Any]:
-    user_id = payload.get("sub")
-    for u in _users_db.values():
-        if u.get("id") == user_id:
-            return u
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Usuário não encontrado")
+    u = _users_by_id.get(payload.get("sub"))
+    if u is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Usuário não encontrado")
+    return u
 
 # ==== Router ====
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 @router.post("/register", response_model=dict, status_code=status.HTTP_201_CREATED)
 async def register(user_data: UserRegister = Body(...)):
+    if user_data.email in _users_db:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email já registrado")
+    password_hash = await _hash_password_async(user_data.password)
+    # re-check after the await: another request may have registered the same email meanwhile
     if user_data.email in _users_db:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email já registrado")
     user_id = f"user_{len(_users_db) + 1}"
-    _users_db[user_data.email] = {
+    user = {
         "id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": password_hash,
         "name": user_data.name,
         "created_at": _now_utc().isoformat(),
         "is_active": True,
     }
+    _users_db[user_data.email] = user
+    _users_by_id[user_id] = user
     logger.info("Novo usuário registrado: %s", user_data.email)
     return {"status": "success", "message": "Usuário registrado com sucesso", "user_id": user_id, "email": user_data.email}
 
 @router.post("/login", response_model=TokenResponse)
 async def login(credentials: UserLogin = Body(...)):
     user = _users_db.get(credentials.email)
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await _verify_password_async(credentials.password, user["password"]):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Email ou senha incorretos")
     if not user.get("is_active", True):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Usuário inativo")
+    if password_needs_rehash(user["password"]):
+        user["password"] = await _hash_password_async(credentials.password)
 
     # Se remember_me = True, criar refresh token com validade de 30 dias
     at = create_access_token(user_id=user["id"], email=user["email"])
@@ -213,7 +299,7 @@ async def refresh_token(token_data: TokenRefresh = Body(...)):
     if not user_id or not email:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido")
     # optionally revoke old refresh token and issue new ones (rotate)
-    _revoked_jti_refresh.add(jti)
+    _revoked_jti_refresh.add(jti, payload["exp"])
     at = create_access_token(user_id=user_id, email=email)
     rt = create_refresh_token(user_id=user_id, email=email)
     logger.info("Token renovado para: %s", user_id)
@@ -249,7 +335,7 @@ async def logout(request: Request, payload: Dict[str, Any] = Depends(verify_toke
     # revoke current access token jti and optionally refresh tokens for the user
     jti = payload.get("jti")
     if jti:
-        _revoked_jti_access.add(jti)
+        _revoked_jti_access.add(jti, payload["exp"])
     user_id = payload.get("sub")
     logger.info("Logout: %s", user_id)
     return {"status": "success", "message": "Logout realizado com sucesso"}
@@ -272,13 +358,12 @@ async def password_reset_confirm(reset_confirm: PasswordResetConfirm = Body(...)
         if payload.get("type") != "reset":
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido")
         user_id = payload.get("sub")
-        # find user by id
-        for email, u in list(_users_db.items()):
-            if u.get("id") == user_id:
-                u["password"] = hash_password(reset_confirm.new_password)
-                logger.info("Senha resetada para %s", email)
-                return {"status": "success", "message": "Senha alterada com sucesso"}
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Usuário não encontrado")
+        u = _users_by_id.get(user_id)
+        if u is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Usuário não encontrado")
+        u["password"] = await _hash_password_async(reset_confirm.new_password)
+        logger.info("Senha resetada para %s", u["email"])
+        return {"status": "success", "message": "Senha alterada com sucesso"}
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expirado ou inválido")
 
@@ -288,7 +373,7 @@ def _create_dev_admin_if_missing():
     if demo_email not in _users_db:
         # Truncar senha explicitamente antes de passar para hash_password
         raw_password = os.getenv("DEV_ADMIN_PASSWORD", "Admin123!")
-        _users_db[demo_email] = {
+        admin = {
             "id": "user_0",
             "email": demo_email,
             "password": hash_password(raw_password),
@@ -296,6 +381,8 @@ def _create_dev_admin_if_missing():
             "created_at": _now_utc().isoformat(),
             "is_active": True,
         }
+        _users_db[demo_email] = admin
+        _users_by_id[admin["id"]] = admin
 
 # Chamar no startup para criar admin de desenvolvimento
 _create_dev_admin_if_missing()
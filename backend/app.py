@@ -2,25 +2,37 @@
 # SISTEMA COMPLETO ENTERPRISE
 # Inclui: JWT, Histórico, Exportação (PDF/Excel), WhatsApp e Google Sheets
 
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Body
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
-from jose import jwt, JWTError
+from fastapi.responses import FileResponse, StreamingResponse, ORJSONResponse
+import jwt
+from jwt import InvalidTokenError as JWTError
+import bcrypt
 from datetime import datetime, timedelta
 from pathlib import Path
-import shutil
+import asyncio
+import aiofiles
+import orjson
 import pandas as pd
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
+from openpyxl.utils import get_column_letter
 import uuid
+import secrets
+import hashlib
+import time
 import csv
 from typing import Optional, Dict, Any, List
 import os
-import requests
+import aiohttp
 import io
+from collections import deque
+from functools import lru_cache
+from itertools import islice
 
 # Serviço de cache SQLite
 from cache_service import cache_service
@@ -36,7 +48,8 @@ TOKEN_EXPIRE_MIN = 60
 app = FastAPI(
     title="Chat IA Corporativo",
     description="API Enterprise para Análise de Relatórios com IA",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 security = HTTPBearer()
@@ -48,6 +61,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Respostas JSON (chaves repetidas por linha) comprimem muito bem
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 BASE_DIR = Path("data")
 BASE_DIR.mkdir(exist_ok=True)
@@ -56,18 +71,67 @@ UPLOADS_DIR = BASE_DIR / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
 EXPORTS_DIR = BASE_DIR / "exports"
 EXPORTS_DIR.mkdir(exist_ok=True)
+SHEETS_CACHE_DIR = BASE_DIR / "sheets_cache"
+SHEETS_CACHE_DIR.mkdir(exist_ok=True)
+
+LOGS_FIELDS = ["timestamp", "usuario", "tipo", "codvd", "vendedor", "registros"]
+LOGS_RECENTES_MAX = 1000
 
 # Inicializar arquivo de logs
 if not LOGS_FILE.exists():
     with open(LOGS_FILE, "w", encoding="utf-8") as f:
-        f.write("timestamp,usuario,tipo,codvd,vendedor,registros\n")
+        f.write(",".join(LOGS_FIELDS) + "\n")
+
+
+def _carregar_logs_recentes() -> deque:
+    """Lê apenas o final do logs.csv (último 1 MiB) para popular o histórico em memória"""
+    recentes: deque = deque(maxlen=LOGS_RECENTES_MAX)
+    with open(LOGS_FILE, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        tamanho = f.tell()
+        inicio = max(0, tamanho - (1 << 20))
+        f.seek(inicio)
+        bruto = f.read()
+    texto = bruto.decode("utf-8", errors="ignore")
+    linhas = texto.splitlines()
+    if inicio > 0:
+        linhas = linhas[1:]  # primeira linha pode estar cortada no meio
+    elif linhas:
+        linhas = linhas[1:]  # cabeçalho
+    for row in csv.DictReader(linhas, fieldnames=LOGS_FIELDS):
+        # CSV devolve tudo como texto; volta aos ints gravados por salvar_log
+        for campo in ("codvd", "registros"):
+            valor = row.get(campo)
+            if valor and valor.lstrip("-").isdigit():
+                row[campo] = int(valor)
+        recentes.append(row)
+    return recentes
+
+
+# Últimos registros de histórico (o CSV em disco fica somente para escrita)
+_recent_logs: deque = _carregar_logs_recentes()
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode("utf-8")[:72], bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    # bcrypt.checkpw compara o digest em tempo constante
+    try:
+        return bcrypt.checkpw(plain_password.encode("utf-8")[:72], hashed_password.encode("utf-8"))
+    except Exception:
+        return False
 
-# Banco de dados de usuários (em produção, usar BD real)
+
+# Banco de dados de usuários (em produção, usar BD real) - só os hashes bcrypt ficam no código
 USERS_DB = {
-    "admin@teste.com": {"password": "123456", "role": "admin", "name": "Admin Teste"},
-    "teste@teste.com": {"password": "123456", "role": "user", "name": "Usuário Teste"},
-    "nathiely@empresa.com": {"password": "Nathiely@2025", "role": "admin", "name": "Nathiely"},
-    "roberto.felix@empresa.com": {"password": "Roberto@2025", "role": "admin", "name": "Roberto Felix"},
+    "admin@teste.com": {"password": "$2b$10$5ULuUoqien/kI8JzxDnjX.o1ZMt1FeM/qjid29tLSAYB8yTsrTyzO", "role": "admin", "name": "Admin Teste"},
+    "teste@teste.com": {"password": "$2b$10$zlhXh5P2psVFHcQw/pw9JOFKWJnuNtecUlYa5z36dQC//NSYZUAEm", "role": "user", "name": "Usuário Teste"},
+    "nathiely@empresa.com": {"password": "$2b$10$qNd16Qb4hpyn2dZl4njOxOd07yfM4jtUhelFC/8R7JFXSZ2PKf2Gu", "role": "admin", "name": "Nathiely"},
+    "roberto.felix@empresa.com": {"password": "$2b$10$n451wn/1Ob7rSCAdwPACxeZ0b.WPdvfwM3LtixorIkNcueWT/AGWm", "role": "admin", "name": "Roberto Felix"},
 }
 
 # =========================
@@ -83,12 +147,22 @@ def criar_token(email: str, role: str = "user"):
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
+@lru_cache(maxsize=4096)
+def _decode_token(token: str) -> tuple:
+    """Valida a assinatura uma vez por token; só decodificações bem-sucedidas vão para o cache"""
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    return payload["sub"], payload.get("role", "user"), payload["exp"]
+
+
 def get_user(token: HTTPAuthorizationCredentials = Depends(security)):
     try:
-        payload = jwt.decode(token.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        return {"email": payload["sub"], "role": payload.get("role", "user")}
-    except JWTError:
+        email, role, exp = _decode_token(token.credentials)
+    except (JWTError, KeyError):
+        raise HTTPException(403, "Token inválido ou expirado")
+    # Expiração conferida a cada chamada, pois o payload em cache pode sobreviver ao token
+    if exp <= time.time():
         raise HTTPException(403, "Token inválido ou expirado")
+    return {"email": email, "role": role}
 
 # =========================
 # AUTH
@@ -103,7 +177,7 @@ def login(credentials: Dict[str, Any] = Body(...)):
         raise HTTPException(400, "Email e senha são obrigatórios")
     
     user = USERS_DB.get(email)
-    if not user or user["password"] != password:
+    if not user or not verify_password(password, user["password"]):
         raise HTTPException(401, "Credenciais inválidas")
     
     token = criar_token(email, user["role"])
@@ -131,7 +205,7 @@ def register(credentials: Dict[str, Any] = Body(...)):
         raise HTTPException(400, "Usuário já existe")
     
     USERS_DB[email] = {
-        "password": password,
+        "password": hash_password(password),
         "role": "user",
         "name": name
     }
@@ -174,34 +248,48 @@ def salvar_log(usuario, tipo, codvd, vendedor, registros):
     }
     
     with open(LOGS_FILE, "a", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=["timestamp", "usuario", "tipo", "codvd", "vendedor", "registros"])
+        writer = csv.DictWriter(f, fieldnames=LOGS_FIELDS)
         writer.writerow(linha)
+    _recent_logs.append(linha)
 
 
 @app.get("/api/historico")
 def obter_historico(user_data = Depends(get_user)):
-    if not LOGS_FILE.exists():
-        return {"historico": []}
-    
-    df = pd.read_csv(LOGS_FILE)
-    
+    # Cópia antes de filtrar: salvar_log pode dar append em outra thread do threadpool
+    snap = list(_recent_logs)
     # Se não for admin, mostrar apenas do próprio usuário
     if user_data["role"] != "admin":
-        df = df[df["usuario"] == user_data["email"]]
+        historico = [r for r in snap if r["usuario"] == user_data["email"]]
+    else:
+        historico = snap
     
     # Últimos 100 registros
-    df = df.tail(100)
-    
     return {
-        "historico": df.to_dict(orient="records")
+        "historico": historico[-100:]
     }
 
 # =========================
 # UPLOAD DE PLANILHAS
 # =========================
 
+def _salvar_parquet(df: pd.DataFrame, origem: Path) -> Optional[Path]:
+    """Grava uma cópia colunar (.parquet) ao lado da planilha para leituras rápidas nos relatórios"""
+    parquet_path = origem.with_suffix(".parquet")
+    # tmp único + replace: leitores concorrentes nunca veem um parquet pela metade
+    tmp = origem.with_name(f"{origem.stem}.{uuid.uuid4().hex}.parquet.tmp")
+    try:
+        df.to_parquet(tmp, engine="pyarrow", compression="zstd", index=False)
+        tmp.replace(parquet_path)
+        return parquet_path
+    except Exception as e:
+        # Colunas com tipos mistos podem não ser convertidas; o relatório volta a ler o Excel
+        print(f"⚠️ Não foi possível gerar parquet para {origem.name}: {e}")
+        tmp.unlink(missing_ok=True)
+        return None
+
+
 @app.post("/api/upload/excel")
-def upload_excel(file: UploadFile = File(...), user_data = Depends(get_user)):
+async def upload_excel(file: UploadFile = File(...), user_data = Depends(get_user)):
     # Apenas admins podem fazer upload
     if user_data["role"] != "admin":
         raise HTTPException(403, "Apenas administradores podem fazer upload")
@@ -211,19 +299,21 @@ def upload_excel(file: UploadFile = File(...), user_data = Depends(get_user)):
         raise HTTPException(400, "Arquivo deve ser Excel ou CSV")
     
     # Salvar arquivo
-    file_id = str(uuid.uuid4())
+    file_id = secrets.token_urlsafe(16)
     ext = Path(file.filename).suffix
     file_path = UPLOADS_DIR / f"{file_id}{ext}"
     
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # Gravar em blocos sem bloquear o event loop
+    async with aiofiles.open(file_path, "wb") as f:
+        while chunk := await file.read(1 << 20):
+            await f.write(chunk)
     
-    # Tentar ler para validar
+    # Tentar ler para validar (parse fora do event loop)
     try:
         if ext == '.csv':
-            df = pd.read_csv(file_path)
+            df = await asyncio.to_thread(pd.read_csv, file_path)
         else:
-            df = pd.read_excel(file_path)
+            df = await asyncio.to_thread(pd.read_excel, file_path)
         
         return {
             "file_id": file_id,
@@ -243,6 +333,12 @@ def upload_excel(file: UploadFile = File(...), user_data = Depends(get_user)):
 def exportar_excel(df: pd.DataFrame, filename: str):
     path = EXPORTS_DIR / f"{filename}_{uuid.uuid4().hex[:8]}.xlsx"
     
+    # Largura das colunas calculada no pandas (vetorizado), antes de escrever
+    widths = {
+        col: min(max(int(df[col].astype(str).str.len().max()) if len(df) else 0, len(str(col))) + 2, 50)
+        for col in df.columns
+    }
+    
     # Criar Excel com formatação
     with pd.ExcelWriter(path, engine='openpyxl') as writer:
         df.to_excel(writer, index=False, sheet_name='Relatório')
@@ -251,26 +347,31 @@ def exportar_excel(df: pd.DataFrame, filename: str):
         worksheet = writer.sheets['Relatório']
         
         # Ajustar largura das colunas
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            worksheet.column_dimensions[column_letter].width = adjusted_width
+        for idx, width in enumerate(widths.values(), start=1):
+            worksheet.column_dimensions[get_column_letter(idx)].width = width
     
     return path
 
 
+# Estilos do PDF são constantes: montados uma vez no import e reutilizados
+_PDF_STYLES = getSampleStyleSheet()
+_PDF_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
+
 def exportar_pdf(df: pd.DataFrame, titulo: str, filename: str):
     path = EXPORTS_DIR / f"{filename}_{uuid.uuid4().hex[:8]}.pdf"
     
     doc = SimpleDocTemplate(str(path), pagesize=A4)
-    styles = getSampleStyleSheet()
+    styles = _PDF_STYLES
     elementos = []
     
     # Título
@@ -290,16 +391,7 @@ def exportar_pdf(df: pd.DataFrame, titulo: str, filename: str):
         
         # Criar tabela
         table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
+        table.setStyle(_PDF_TABLE_STYLE)
         
         elementos.append(table)
         
@@ -313,6 +405,84 @@ def exportar_pdf(df: pd.DataFrame, titulo: str, filename: str):
 # RELATÓRIOS
 # =========================
 
+# Arquivo de dados de cada tipo de relatório
+# Por padrão, busca arquivos .xlsx com nome do tipo
+ARQUIVO_MAPEAMENTO: Dict[str, str] = {
+    "nao_cobertos_clientes": "nao_cobertos.xlsx",
+    "nao_cobertos_fornecedor": "nao_cobertos.xlsx",
+    "msl_mini": "msl.xlsx",
+    "msl_super": "msl.xlsx",
+    "msl_otg": "msl.xlsx",
+    "msl_danone": "msl.xlsx",
+    "exp": "msl.xlsx",
+    "novos_clientes": "novos_clientes.xlsx",
+    "queijo_reino": "queijo_reino.xlsx",
+}
+
+
+# Colunas auxiliares de filtro: as originais (STATUS/CODVD) saem intactas no JSON/Excel/PDF
+_STATUS_NORM = "_status_norm"
+_CODVD_NORM = "_codvd_norm"
+
+
+@lru_cache(maxsize=32)
+def _load_df(path_str: str, mtime_ns: int) -> pd.DataFrame:
+    """Lê a planilha uma única vez por versão do arquivo (mtime_ns entra na chave do cache)
+
+    A chave é sempre a planilha original: a cópia .parquet gravada aqui só acelera a leitura
+    após um restart, sem gerar uma segunda entrada (e um segundo parse) no cache.
+    """
+    path = Path(path_str)
+    parquet_path = path.with_suffix(".parquet")
+    try:
+        # Prefere a cópia .parquet quando ela é mais nova que a planilha
+        usar_parquet = parquet_path.stat().st_mtime_ns >= mtime_ns
+    except FileNotFoundError:
+        usar_parquet = False
+    if usar_parquet:
+        df = pd.read_parquet(parquet_path, engine="pyarrow")
+    else:
+        df = pd.read_excel(path)
+        _salvar_parquet(df, path)
+    # Normaliza as colunas de filtro uma vez, na carga, em vez de a cada requisição
+    if "STATUS" in df.columns:
+        df[_STATUS_NORM] = df["STATUS"].astype("string").str.upper().str.strip().astype("category")
+    if "CODVD" in df.columns:
+        df[_CODVD_NORM] = df["CODVD"].astype(str).str.strip()
+    return df
+
+
+def _json_default(obj: Any):
+    """Fallback do orjson para tipos do pandas/numpy (Timestamp, NaT, numpy scalars...)"""
+    if obj is pd.NaT:
+        return None
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+
+# Linhas por chunk: cada yield é um salto de thread + um frame chunked (+ gzip), então agrupa
+RELATORIO_STREAM_LOTE = int(os.getenv("RELATORIO_STREAM_LOTE", "2000"))
+
+
+def _stream_relatorio_json(cabecalho: Dict[str, Any], df: pd.DataFrame):
+    # cabeçalho serializado sem a chave de fechamento, seguido do array "dados"
+    yield orjson.dumps(cabecalho, default=_json_default)[:-1] + b',"dados":['
+    colunas = [str(c) for c in df.columns]
+    linhas = df.itertuples(index=False, name=None)
+    separador = b""
+    while True:
+        lote = [dict(zip(colunas, row)) for row in islice(linhas, RELATORIO_STREAM_LOTE)]
+        if not lote:
+            break
+        # lista serializada sem os colchetes = objetos já separados por vírgula
+        yield separador + orjson.dumps(lote, default=_json_default)[1:-1]
+        separador = b","
+    yield b"]}"
+
+
 @app.post("/api/relatorios/gerar")
 def gerar_relatorio(payload: Dict[str, Any] = Body(...), user_data = Depends(get_user)):
     tipo = payload.get("tipo")
@@ -324,20 +494,7 @@ def gerar_relatorio(payload: Dict[str, Any] = Body(...), user_data = Depends(get
         raise HTTPException(400, "Tipo e CODVD são obrigatórios")
     
     # Buscar arquivo de dados correspondente
-    # Por padrão, busca arquivos .xlsx com nome do tipo
-    arquivo_mapeamento = {
-        "nao_cobertos_clientes": "nao_cobertos.xlsx",
-        "nao_cobertos_fornecedor": "nao_cobertos.xlsx",
-        "msl_mini": "msl.xlsx",
-        "msl_super": "msl.xlsx",
-        "msl_otg": "msl.xlsx",
-        "msl_danone": "msl.xlsx",
-        "exp": "msl.xlsx",
-        "novos_clientes": "novos_clientes.xlsx",
-        "queijo_reino": "queijo_reino.xlsx",
-    }
-    
-    arquivo_nome = arquivo_mapeamento.get(tipo)
+    arquivo_nome = ARQUIVO_MAPEAMENTO.get(tipo)
     if not arquivo_nome:
         raise HTTPException(400, f"Tipo de relatório desconhecido: {tipo}")
     
@@ -348,18 +505,19 @@ def gerar_relatorio(payload: Dict[str, Any] = Body(...), user_data = Depends(get
     
     # Ler dados
     try:
-        df = pd.read_excel(arquivo_path)
+        # .copy() protege o DataFrame em cache dos filtros abaixo
+        df = _load_df(str(arquivo_path), arquivo_path.stat().st_mtime_ns).copy()
     except Exception as e:
         raise HTTPException(500, f"Erro ao ler arquivo: {str(e)}")
     
-    # Aplicar filtros
+    # Filtros de CODVD e STATUS combinados numa única máscara: um só recorte do DataFrame
+    # (usa as colunas normalizadas em _load_df, descartadas logo após o recorte)
+    mask = df[_CODVD_NORM] == str(codvd).strip()
     if tipo.startswith("nao_cobertos"):
-        df = df[df["STATUS"].str.upper().str.strip() == "FALTA"]
+        mask &= df[_STATUS_NORM] == "FALTA"
     elif tipo.startswith("msl") or tipo == "exp":
-        df = df[df["STATUS"].str.upper().str.strip().isin(["OK", "FALTA"])]
-    
-    # Filtrar por CODVD
-    df = df[df["CODVD"].astype(str).str.strip() == str(codvd).strip()]
+        mask &= df[_STATUS_NORM].isin(["OK", "FALTA"])
+    df = df[mask].drop(columns=[c for c in (_STATUS_NORM, _CODVD_NORM) if c in df.columns])
     
     # Filtrar por vendedor se fornecido
     if vendedor:
@@ -381,14 +539,14 @@ def gerar_relatorio(payload: Dict[str, Any] = Body(...), user_data = Depends(get
         return FileResponse(path, filename=f"{tipo}.pdf", media_type="application/pdf")
     
     else:
-        # JSON
-        return {
+        # JSON em streaming: linha a linha, sem montar a lista de dicts inteira em memória
+        cabecalho = {
             "tipo": tipo,
             "codvd": codvd,
             "vendedor": vendedor,
             "total_registros": len(df),
-            "dados": df.to_dict(orient="records")
         }
+        return StreamingResponse(_stream_relatorio_json(cabecalho, df), media_type="application/json")
 
 # =========================
 # WHATSAPP
@@ -462,11 +620,32 @@ REPORTS_CONFIG = [
     }
 ]
 
+# Índice id -> config e parte estática da listagem /api/sheets, montados uma vez
+_REPORTS_BY_ID: Dict[str, Dict[str, Any]] = {c["id"]: c for c in REPORTS_CONFIG}
+_SHEETS_STATIC: List[Dict[str, Any]] = [
+    {"id": c["id"], "label": c["label"], "keywords": c["keywords"], "type": c["type"]}
+    for c in REPORTS_CONFIG
+]
+
 # Cache em memória para os dados das planilhas
-report_data_cache: Dict[str, List[Dict]] = {}
+report_data_cache: Dict[str, pd.DataFrame] = {}
+_report_etags: Dict[str, str] = {}
 report_validation_status: Dict[str, Dict] = {}
 is_loading_sheets = False
 last_update_time = None
+_reload_inflight: Optional[asyncio.Task] = None
+_reload_forced = False  # a carga em andamento (ou a encadeada) ignora o cache de 24h
+
+# Revalidação das planilhas: ETag/Last-Modified por relatório + janela mínima entre downloads
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+_sheet_meta: Dict[str, Dict[str, Any]] = {}
+
+# Limite de downloads simultâneos (evita 429 do Google quando há muitas planilhas)
+_SHEETS_SEM = asyncio.Semaphore(int(os.getenv("SHEETS_CONCURRENCY", "5")))
+SHEETS_MAX_RETRIES = 3
+
+# Cópias parquet das planilhas mais novas que isso são usadas para servir já no startup
+SHEETS_PARQUET_MAX_AGE = int(os.getenv("SHEETS_PARQUET_MAX_AGE", "3600"))
 
 # Schemas esperados para validação
 REPORT_SCHEMAS = {
@@ -485,16 +664,16 @@ REPORT_SCHEMAS = {
 }
 
 
-def validate_report_schema(report_id: str, data: List[Dict]) -> Dict:
+def validate_report_schema(report_id: str, data: pd.DataFrame) -> Dict:
     """Valida se os dados correspondem ao schema esperado"""
-    if not data:
+    if data.empty:
         return {"ok": False, "error": "Dados vazios"}
     
     schema = REPORT_SCHEMAS.get(report_id)
     if not schema:
         return {"ok": True, "warning": "Schema não definido"}
     
-    headers = list(data[0].keys())
+    headers = [str(col) for col in data.columns]
     expected_columns = schema["columns"]
     missing_columns = [col for col in expected_columns if col not in headers]
     extra_columns = [col for col in headers if col not in expected_columns]
@@ -509,14 +688,141 @@ def validate_report_schema(report_id: str, data: List[Dict]) -> Dict:
     }
 
 
-def parse_csv_text(text: str) -> List[Dict[str, str]]:
-    """Parser de CSV robusto"""
-    lines = [line for line in text.split('\n') if line.strip()]
-    if not lines:
-        return []
+def parse_csv_text(text: str) -> pd.DataFrame:
+    """Parser de CSV robusto
     
-    reader = csv.DictReader(io.StringIO('\n'.join(lines)))
-    return [row for row in reader]
+    Usa o tokenizador em C do pandas e guarda os dados em colunas (sem um dict
+    por linha). Todas as células ficam como texto, como no CSV publicado, e
+    linhas em branco são descartadas.
+    """
+    if not text or text.isspace():
+        return pd.DataFrame()
+    try:
+        df = pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False, skip_blank_lines=True)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+    # Linhas só com espaços/vazias em todas as colunas
+    if not df.empty:
+        df = df[(df.apply(lambda col: col.str.strip()) != "").any(axis=1)].reset_index(drop=True)
+    return df
+
+
+def _calcular_etag(df: pd.DataFrame) -> str:
+    """Hash do conteúdo (colunas + valores) usado como ETag da planilha"""
+    h = hashlib.sha1("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def _atualizar_cache(cache: Dict[str, pd.DataFrame], etags: Dict[str, str], report_id: str, df: pd.DataFrame) -> None:
+    cache[report_id] = df
+    etags[report_id] = _calcular_etag(df)
+
+
+def _dataframe_do_cache(cached: Dict[str, Any]) -> pd.DataFrame:
+    """Reconstrói o DataFrame a partir dos registros salvos no cache SQLite"""
+    return pd.DataFrame(cached["data"], dtype=str)
+
+
+def _persistir_planilha(report_id: str, df: pd.DataFrame) -> None:
+    """Grava a planilha baixada em parquet (zstd) para o próximo restart não depender do Google"""
+    if df.empty:
+        return
+    destino = SHEETS_CACHE_DIR / f"{report_id}.parquet"
+    tmp = destino.with_suffix(".parquet.tmp")
+    try:
+        df.to_parquet(tmp, engine="pyarrow", compression="zstd", index=False)
+        tmp.replace(destino)
+    except Exception as e:
+        print(f"⚠️ Não foi possível salvar parquet de {report_id}: {e}")
+        tmp.unlink(missing_ok=True)
+
+
+def _carregar_planilhas_parquet() -> int:
+    """Publica no cache as cópias parquet recentes; retorna quantas foram carregadas"""
+    novo_cache = dict(report_data_cache)
+    novas_etags = dict(_report_etags)
+    nova_validacao = dict(report_validation_status)
+    carregadas = 0
+    agora = time.time()
+    for config in REPORTS_CONFIG:
+        path = SHEETS_CACHE_DIR / f"{config['id']}.parquet"
+        try:
+            if agora - path.stat().st_mtime >= SHEETS_PARQUET_MAX_AGE:
+                continue
+            df = pd.read_parquet(path, engine="pyarrow")
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            print(f"⚠️ Parquet de {config['label']} ilegível: {e}")
+            continue
+        _atualizar_cache(novo_cache, novas_etags, config["id"], df)
+        nova_validacao[config["id"]] = validate_report_schema(config["id"], df)
+        carregadas += 1
+        print(f"  📦 {config['label']}: {len(df)} linhas (parquet)")
+    if carregadas:
+        _publicar_cache(novo_cache, novas_etags, nova_validacao)
+    return carregadas
+
+
+def _planilha_recente(report_id: str) -> bool:
+    """True se a planilha foi baixada/revalidada há menos de CACHE_TTL segundos"""
+    meta = _sheet_meta.get(report_id)
+    return bool(meta) and report_id in report_data_cache and time.monotonic() - meta["fetched_at"] < CACHE_TTL
+
+
+async def _baixar_planilha(session: aiohttp.ClientSession, config: Dict[str, Any]) -> Optional[str]:
+    """Baixa o CSV publicado de uma planilha
+    
+    Usa GET condicional (ETag / Last-Modified) e retorna None quando o Google
+    responde 304, ou seja, quando os dados em memória continuam válidos.
+    """
+    meta = _sheet_meta.get(config["id"], {})
+    headers = {}
+    if config["id"] in report_data_cache:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    
+    for tentativa in range(SHEETS_MAX_RETRIES + 1):
+        async with _SHEETS_SEM:
+            async with session.get(config["url"], headers=headers) as response:
+                if response.status == 429 and tentativa < SHEETS_MAX_RETRIES:
+                    espera = _segundos_retry_after(response.headers.get("Retry-After"), tentativa)
+                else:
+                    if response.status == 304:
+                        meta["fetched_at"] = time.monotonic()
+                        return None
+                    response.raise_for_status()
+                    text = await response.text()
+                    _sheet_meta[config["id"]] = {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "fetched_at": time.monotonic(),
+                    }
+                    return text
+        # 429: espera fora do semáforo para não segurar a vaga de outros downloads
+        print(f"⏳ {config['label']}: 429 do Google, nova tentativa em {espera:.1f}s")
+        await asyncio.sleep(espera)
+
+
+def _segundos_retry_after(valor: Optional[str], tentativa: int) -> float:
+    """Tempo de espera após um 429: usa Retry-After (segundos) ou backoff exponencial"""
+    try:
+        return min(float(valor), 30.0)
+    except (TypeError, ValueError):
+        return float(2 ** tentativa)
+
+
+def _sessao_http() -> aiohttp.ClientSession:
+    """Sessão HTTP compartilhada entre recargas (reaproveita conexões TLS e DNS)"""
+    session = getattr(app.state, "http", None)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=30)
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10))
+        app.state.http = session
+    return session
 
 
 async def carregar_dados_sheets(force_refresh: bool = False):
@@ -525,9 +831,51 @@ async def carregar_dados_sheets(force_refresh: bool = False):
     Args:
         force_refresh: Se True, ignora cache e busca do Google Sheets
     """
-    global is_loading_sheets, last_update_time
+    global _reload_inflight, _reload_forced, is_loading_sheets
+    # Recargas simultâneas compartilham a carga em andamento em vez de baixar de novo
+    if _reload_inflight is None or _reload_inflight.done():
+        is_loading_sheets = True
+        _reload_forced = force_refresh
+        _reload_inflight = asyncio.create_task(_carregar_dados_sheets(force_refresh))
+    elif force_refresh and not _reload_forced:
+        # Carga em andamento não forçada (ex.: prewarm): encadeia uma forçada depois dela
+        _reload_forced = True
+        _reload_inflight = asyncio.create_task(_recarregar_forcado_apos(_reload_inflight))
+    # shield: cancelar uma requisição não cancela a carga usada pelas demais
+    return await asyncio.shield(_reload_inflight)
+
+
+async def _recarregar_forcado_apos(anterior: asyncio.Task):
+    try:
+        await anterior
+    except Exception:
+        pass  # a falha da carga anterior já foi tratada por quem a aguardava
+    return await _carregar_dados_sheets(True)
+
+
+async def _carregar_dados_sheets(force_refresh: bool):
+    global is_loading_sheets
     is_loading_sheets = True
+    try:
+        return await _montar_e_trocar_cache(force_refresh)
+    finally:
+        is_loading_sheets = False
+
+
+def _publicar_cache(cache: Dict[str, pd.DataFrame], etags: Dict[str, str], validacao: Dict[str, Dict]) -> Dict[str, pd.DataFrame]:
+    """Troca os dicts globais de uma vez: leitores nunca veem uma recarga pela metade"""
+    global report_data_cache, _report_etags, report_validation_status, last_update_time
+    report_data_cache, _report_etags, report_validation_status = cache, etags, validacao
+    last_update_time = datetime.now().isoformat()
+    return cache
+
+
+async def _montar_e_trocar_cache(force_refresh: bool):
     print("📥 Carregando planilhas do Google Sheets...")
+    # Cópias locais: a recarga é montada à parte e publicada no final
+    novo_cache = dict(report_data_cache)
+    novas_etags = dict(_report_etags)
+    nova_validacao = dict(report_validation_status)
     
     # Se não forçar, tenta usar cache (24h)
     if not force_refresh:
@@ -542,42 +890,58 @@ async def carregar_dados_sheets(force_refresh: bool = False):
             for config in REPORTS_CONFIG:
                 cached = cache_service.get_report_cache(config["id"])
                 if cached:
-                    report_data_cache[config["id"]] = cached["data"]
-                    report_validation_status[config["id"]] = cached.get("validation_status", {"ok": True})
+                    _atualizar_cache(novo_cache, novas_etags, config["id"], _dataframe_do_cache(cached))
+                    nova_validacao[config["id"]] = cached.get("validation_status", {"ok": True})
                     print(f"  📋 {config['label']}: {cached['row_count']} linhas (cache)")
             
-            is_loading_sheets = False
-            last_update_time = datetime.now().isoformat()
             print("🟢 Carga concluída via cache")
-            return report_data_cache
+            return _publicar_cache(novo_cache, novas_etags, nova_validacao)
     
-    for config in REPORTS_CONFIG:
+    # Planilhas baixadas há menos de CACHE_TTL segundos são servidas da memória (?force=true ignora o TTL)
+    pendentes = [
+        config for config in REPORTS_CONFIG
+        if force_refresh or not _planilha_recente(config["id"])
+    ]
+    
+    # Downloads em paralelo: o tempo total fica próximo ao da planilha mais lenta
+    session = _sessao_http()
+    resultados = await asyncio.gather(
+        *(_baixar_planilha(session, config) for config in pendentes),
+        return_exceptions=True
+    )
+    
+    for config, resultado in zip(pendentes, resultados):
         try:
-            response = requests.get(config["url"], timeout=10)
-            response.raise_for_status()
+            if isinstance(resultado, BaseException):
+                raise resultado
+            if resultado is None:
+                print(f"♻️ {config['label']} sem alterações (304)")
+                continue
             
-            text = response.text
+            text = resultado
             data = parse_csv_text(text)
             
             # Validar schema
             validation = validate_report_schema(config["id"], data)
-            report_validation_status[config["id"]] = validation
+            nova_validacao[config["id"]] = validation
             
             if validation["ok"]:
-                report_data_cache[config["id"]] = data
+                _atualizar_cache(novo_cache, novas_etags, config["id"], data)
                 print(f"✅ {config['label']} carregado ({len(data)} linhas) - Schema v{validation['version']} OK")
             else:
-                report_data_cache[config["id"]] = data  # Carrega mesmo com erro
+                _atualizar_cache(novo_cache, novas_etags, config["id"], data)  # Carrega mesmo com erro
                 print(f"⚠️ {config['label']} carregado ({len(data)} linhas) - Schema inválido")
                 print(f"   Colunas faltando: {validation.get('missing_columns', [])}")
                 if validation.get('extra_columns'):
                     print(f"   Colunas extras: {validation['extra_columns']}")
             
+            _persistir_planilha(config["id"], data)
+            
             # Salvar no cache SQLite
             cache_service.save_report_cache(
                 report_id=config["id"],
                 label=config["label"],
-                data=data,
+                data=data.to_dict(orient="records"),
                 validation_status=validation
             )
             
@@ -588,35 +952,46 @@ async def carregar_dados_sheets(force_refresh: bool = False):
             cached = cache_service.get_report_cache(config["id"])
             if cached:
                 print(f"   📦 Usando versão em cache ({cached['row_count']} linhas)")
-                report_data_cache[config["id"]] = cached["data"]
-                report_validation_status[config["id"]] = cached.get("validation_status", {"ok": False})
+                _atualizar_cache(novo_cache, novas_etags, config["id"], _dataframe_do_cache(cached))
+                nova_validacao[config["id"]] = cached.get("validation_status", {"ok": False})
             else:
-                report_data_cache[config["id"]] = []
+                _atualizar_cache(novo_cache, novas_etags, config["id"], pd.DataFrame())
     
-    is_loading_sheets = False
-    last_update_time = datetime.now().isoformat()
     print("🟢 Carga finalizada")
-    return report_data_cache
+    return _publicar_cache(novo_cache, novas_etags, nova_validacao)
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Carrega dados das planilhas ao iniciar o servidor"""
-    await carregar_dados_sheets()
+    """Dispara a carga das planilhas em segundo plano: o servidor aceita conexões na hora"""
+    # Cópias parquet recentes atendem de imediato; a carga abaixo atualiza por trás
+    _carregar_planilhas_parquet()
+    app.state.prewarm = asyncio.create_task(carregar_dados_sheets())
+    app.state.prewarm.add_done_callback(_log_falha_prewarm)
+
+
+def _log_falha_prewarm(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        print(f"❌ Falha na carga inicial das planilhas: {task.exception()}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Fecha a sessão HTTP compartilhada"""
+    session = getattr(app.state, "http", None)
+    if session is not None and not session.closed:
+        await session.close()
 
 
 @app.get("/api/sheets/reload")
-def reload_sheets(force: bool = True, user: dict = Depends(get_user)):
+async def reload_sheets(force: bool = True, user: dict = Depends(get_user)):
     """Recarrega dados das planilhas do Google Sheets
     
     Args:
         force: Se True (padrão), ignora cache e busca do Google Sheets
     """
     try:
-        import asyncio
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(carregar_dados_sheets(force_refresh=force))
+        await carregar_dados_sheets(force_refresh=force)
         
         summary = {
             config["id"]: {
@@ -636,31 +1011,53 @@ def reload_sheets(force: bool = True, user: dict = Depends(get_user)):
         raise HTTPException(500, f"Erro ao recarregar planilhas: {str(e)}")
 
 
-@app.get("/api/sheets/{report_id}")
-def get_sheet_data(report_id: str, user: dict = Depends(get_user)):
-    """Retorna dados de uma planilha específica"""
+@app.get("/api/sheets/{report_id}", response_class=ORJSONResponse)
+def get_sheet_data(request: Request, report_id: str, format: str = "records", user: dict = Depends(get_user)):
+    """Retorna dados de uma planilha específica
+    
+    Args:
+        format: "records" (padrão, lista de objetos) ou "columnar"
+            ({coluna: [valores]}, bem menor para planilhas com muitas linhas)
+    """
     if report_id not in report_data_cache:
+        # Carga inicial ainda em andamento: o cliente tenta de novo em instantes
+        if is_loading_sheets and report_id in _REPORTS_BY_ID:
+            return ORJSONResponse({"status": "loading"}, status_code=503, headers={"Retry-After": "2"})
         raise HTTPException(404, f"Relatório '{report_id}' não encontrado")
+    if format not in ("records", "columnar"):
+        raise HTTPException(400, "format deve ser 'records' ou 'columnar'")
     
-    data = report_data_cache[report_id]
     validation = report_validation_status.get(report_id, {"ok": True})
     
-    return {
-        "id": report_id,
-        "data": data,
-        "count": len(data),
-        "validation": validation,
-        "timestamp": last_update_time
-    }
-    config = next((c for c in REPORTS_CONFIG if c["id"] == report_id), None)
+    # ETag fraco (o GZipMiddleware pode comprimir o corpo) por conteúdo + formato + metadados
+    # (timestamp/validation): o navegador revalida e recebe 304 sem corpo
+    meta = hashlib.sha1(orjson.dumps([last_update_time, validation], default=str)).hexdigest()[:12]
+    tag = f'{_report_etags.get(report_id, "")}-{format}-{meta}'
+    etag = f'W/"{tag}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "max-age=30"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (
+        if_none_match.strip() == "*"
+        or tag in [v.strip().removeprefix("W/").strip('"') for v in if_none_match.split(",")]
+    ):
+        return Response(status_code=304, headers=cache_headers)
     
-    return {
+    df = report_data_cache[report_id]
+    # A conversão acontece só na serialização da resposta
+    data = df.to_dict(orient="list" if format == "columnar" else "records")
+    
+    config = _REPORTS_BY_ID.get(report_id)
+    
+    # Resposta montada diretamente: o orjson serializa sem passar pelo jsonable_encoder
+    return ORJSONResponse({
         "id": report_id,
         "label": config["label"] if config else report_id,
-        "rows": len(data),
+        "format": format,
         "data": data,
-        "timestamp": datetime.now().isoformat()
-    }
+        "count": len(df),
+        "validation": validation,
+        "timestamp": last_update_time
+    }, headers=cache_headers)
 
 
 @app.get("/api/status")
@@ -677,15 +1074,12 @@ def get_status():
 def list_sheets(user: dict = Depends(get_user)):
     """Lista todas as planilhas disponíveis com status de validação"""
     sheets = []
-    for config in REPORTS_CONFIG:
-        data = report_data_cache.get(config["id"], [])
-        validation = report_validation_status.get(config["id"], {"ok": True})
+    for static in _SHEETS_STATIC:
+        data = report_data_cache.get(static["id"], [])
+        validation = report_validation_status.get(static["id"], {"ok": True})
         
         sheets.append({
-            "id": config["id"],
-            "label": config["label"],
-            "keywords": config["keywords"],
-            "type": config["type"],
+            **static,
             "rows": len(data),
             "has_data": len(data) > 0,
             "validation": {
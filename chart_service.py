@@ -1,12 +1,18 @@
 ﻿from typing import Optional, List, Dict, Any
 import os
+import re
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 from pathlib import Path
 import logging
+import orjson
 import pandas as pd
 
-from fastapi import APIRouter, Body, HTTPException, Depends, Request
+from fastapi import APIRouter, Body, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 
 from dotenv import load_dotenv
 from chart_service import (
@@ -33,6 +39,17 @@ CHARTS_DIR.mkdir(parents=True, exist_ok=True)
 EXCEL_UPLOAD_DIR = Path(os.getenv("EXCEL_UPLOAD_DIR", "uploads/excel")).resolve()
 EXCEL_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# gráficos em cache (nome = hash do pedido) não acessados há mais que isso são removidos
+CHART_CACHE_MAX_AGE_DAYS = int(os.getenv("CHART_CACHE_MAX_AGE_DAYS", 7))
+_CHART_EVICT_INTERVAL = 3600.0
+_last_chart_eviction = 0.0
+
+# nomes de arquivo aceitos: sem barras, sem diretórios (bloqueia path traversal já na validação)
+_SAFE_NAME_RE = re.compile(r"[A-Za-z0-9._-]{1,255}")
+
+# renderização (pandas + matplotlib) é CPU pura: roda em processos para não disputar o GIL
+_CHART_POOL = ProcessPoolExecutor(max_workers=int(os.getenv("CHART_WORKERS", os.cpu_count() or 1)))
+
 
 class ChartRequest(BaseModel):
     graph_type: str
@@ -43,33 +60,84 @@ class ChartRequest(BaseModel):
     stored_file: Optional[str] = None
     sheet_name: Optional[str] = None
     usecols: Optional[List[str]] = None
-    # aceitar dados diretos (lista de objetos/dicionários)
-    rows: Optional[List[Dict[str, Any]]] = None
+    # aceitar dados diretos (lista não vazia de objetos/dicionários, validada pelo pydantic)
+    rows: Optional[List[Dict[str, Any]]] = Field(None, min_length=1)
 
-
-def _safe_filename(name: str) -> str:
-    """Retorna apenas o nome do arquivo (sem diretórios). Valida inputs simples."""
-    if not name or not isinstance(name, str):
-        raise ValueError("Nome de arquivo inválido")
-    # remove qualquer tentativa de traversal
-    base = Path(name).name
-    if base in ("", ".", ".."):
-        raise ValueError("Nome de arquivo inválido")
-    return base
+    @field_validator("stored_file")
+    @classmethod
+    def _check_stored_file(cls, v: Optional[str]) -> Optional[str]:
+        if v is not None and (not _SAFE_NAME_RE.fullmatch(v) or v in (".", "..")):
+            raise ValueError("Nome de arquivo inválido")
+        return v
 
 
 def _ensure_within_dir(path: Path, parent_dir: Path) -> None:
-    """Resolve e valida que `path` está dentro de `parent_dir` (para evitar path traversal)."""
+    """Valida que `path` está dentro de `parent_dir` (para evitar path traversal).
+
+    `parent_dir` deve vir já resolvido (CHARTS_DIR / EXCEL_UPLOAD_DIR são resolvidos no import).
+    """
     try:
-        resolved = path.resolve()
+        resolved = str(path.resolve())
     except Exception:
         raise HTTPException(status_code=400, detail="Caminho inválido")
-    if parent_dir.resolve() not in resolved.parents and resolved != parent_dir.resolve():
+    parent = str(parent_dir)
+    if os.path.commonpath([resolved, parent]) != parent:
         raise HTTPException(status_code=403, detail="Acesso negado")
 
 
+def _chart_cache_key(req: ChartRequest) -> str:
+    """Hash estável do pedido: mesmo payload -> mesmo PNG."""
+    payload = {
+        "t": req.graph_type, "title": req.title, "d": req.data_column, "c": req.category_column,
+        "rows": req.rows, "file": req.stored_file, "sheet": req.sheet_name, "cols": req.usecols,
+    }
+    if req.stored_file:
+        # inclui a versão do arquivo para não servir gráfico de um upload antigo
+        try:
+            st = (EXCEL_UPLOAD_DIR / Path(req.stored_file).name).stat()
+            payload["file_version"] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            pass
+    return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+
+def _render(
+    rows: Optional[List[Dict[str, Any]]],
+    file_path: Optional[str],
+    graph_type: str,
+    title: str,
+    data_column: str,
+    category_column: Optional[str],
+    sheet_name: Optional[str],
+    usecols: Optional[List[str]],
+) -> str:
+    """Executado no _CHART_POOL (função de topo para ser serializável)."""
+    if rows is not None:
+        return generate_chart_from_rows(rows, graph_type, title, data_column, category_column, top_n=20)
+    return generate_chart_from_file(
+        file_path, graph_type, title, data_column, category_column,
+        sheet_name=sheet_name, usecols=usecols,
+    )
+
+
+def _evict_old_charts() -> None:
+    """Remove PNGs de CHARTS_DIR sem acesso há mais de CHART_CACHE_MAX_AGE_DAYS."""
+    global _last_chart_eviction
+    now = time.time()
+    if now - _last_chart_eviction < _CHART_EVICT_INTERVAL:
+        return
+    _last_chart_eviction = now
+    cutoff = now - CHART_CACHE_MAX_AGE_DAYS * 86400
+    for p in CHARTS_DIR.glob("*.png"):
+        try:
+            if p.stat().st_atime < cutoff:
+                p.unlink(missing_ok=True)
+        except OSError:
+            logger.warning("Falha ao remover gráfico antigo %s", p)
+
+
 @router.post("/generate-chart", summary="Gerar gráfico a partir de arquivo ou dados")
-def generate_chart(req: ChartRequest = Body(...), request: Request = None, _user=Depends(verify_token)):
+async def generate_chart(req: ChartRequest = Body(...), request: Request = None, background_tasks: BackgroundTasks = None, _user=Depends(verify_token)):
     """
     Aceita:
       - stored_file: lê arquivo em uploads/excel (nome seguro)
@@ -80,71 +148,58 @@ def generate_chart(req: ChartRequest = Body(...), request: Request = None, _user
     if request is None:
         raise HTTPException(status_code=400, detail="Request context is required to build chart URL")
 
+    if background_tasks is not None:
+        background_tasks.add_task(_evict_old_charts)
+
     try:
-        # Validação e priorização de rows
+        # Mesmo pedido já renderizado: devolve o PNG existente sem passar pelo matplotlib
+        cache_key = _chart_cache_key(req)
+        cached_path = CHARTS_DIR / f"{cache_key}.png"
+        if cached_path.exists():
+            base = str(request.base_url).rstrip("/")
+            return {"chart_url": f"{base}/chat/charts/{cached_path.name}", "chart_path": str(cached_path)}
+
+        # rows tem prioridade (formato já validado no ChartRequest)
         if req.rows is not None:
-            if not isinstance(req.rows, list) or len(req.rows) == 0:
-                raise HTTPException(status_code=400, detail="'rows' deve ser uma lista não vazia de objetos")
-            # cada item deve ser dict-like
-            for i, r in enumerate(req.rows):
-                if not isinstance(r, dict):
-                    raise HTTPException(status_code=400, detail=f"'rows' deve conter objetos/dicionários (índice {i} inválido)")
-
-            try:
-                saved = generate_chart_from_rows(
-                    req.rows,
-                    req.graph_type,
-                    req.title or "",
-                    req.data_column,
-                    req.category_column,
-                    top_n=20,
-                )
-            except ValueError as e:
-                raise HTTPException(status_code=400, detail=str(e))
+            file_path = None
 
         elif req.stored_file:
-            # Sanitiza nome e protege contra path traversal
-            try:
-                safe_name = _safe_filename(req.stored_file)
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Nome de arquivo inválido")
-
-            file_path = (EXCEL_UPLOAD_DIR / safe_name)
+            # stored_file já validado no ChartRequest (_SAFE_NAME_RE)
+            file_path = (EXCEL_UPLOAD_DIR / req.stored_file)
             # Garante que o arquivo final esteja dentro do diretório esperado
             _ensure_within_dir(file_path, EXCEL_UPLOAD_DIR)
             if not file_path.exists():
                 raise HTTPException(status_code=404, detail="Arquivo armazenado não encontrado")
 
-            try:
-                saved = generate_chart_from_file(
-                    str(file_path),
-                    req.graph_type,
-                    req.title or "",
-                    req.data_column,
-                    req.category_column,
-                    sheet_name=req.sheet_name,
-                    usecols=req.usecols,
-                )
-            except ValueError as e:
-                raise HTTPException(status_code=400, detail=str(e))
-
         else:
             raise HTTPException(status_code=400, detail="Informe 'stored_file' ou 'rows' no payload")
 
-        # Retorna URL absoluta baseada no request
-        filename = Path(saved).name
-        # validações extra no nome retornado
+        loop = asyncio.get_running_loop()
         try:
-            _safe = _safe_filename(filename)
-        except ValueError:
-            # se o chart_service retornou algo inesperado
-            raise HTTPException(status_code=500, detail="Nome do arquivo gerado é inválido")
+            saved = await loop.run_in_executor(
+                _CHART_POOL,
+                _render,
+                req.rows,
+                str(file_path) if file_path is not None else None,
+                req.graph_type,
+                req.title or "",
+                req.data_column,
+                req.category_column,
+                req.sheet_name,
+                req.usecols,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
         # Garante que o arquivo salvo está dentro do CHARTS_DIR
         saved_path = Path(saved)
         _ensure_within_dir(saved_path, CHARTS_DIR)
 
-        relative = f"/chat/charts/{_safe}"
+        # Move para o nome determinístico (hash do pedido) para reaproveitar nas próximas chamadas
+        saved_path = saved_path.replace(cached_path)
+
+        # Retorna URL absoluta baseada no request
+        relative = f"/chat/charts/{saved_path.name}"
         base = str(request.base_url).rstrip("/")
         chart_url = f"{base}{relative}"
 
@@ -159,17 +214,19 @@ def generate_chart(req: ChartRequest = Body(...), request: Request = None, _user
 
 @router.get("/charts/{filename}", summary="Servir imagem de gráfico")
 def serve_chart(filename: str, _user=Depends(verify_token)):
-    # validação simples do nome de arquivo
-    try:
-        safe_name = _safe_filename(filename)
-    except ValueError:
+    # mesmo critério de nome do ChartRequest (sem diretórios, sem traversal)
+    if not _SAFE_NAME_RE.fullmatch(filename) or filename in (".", ".."):
         raise HTTPException(status_code=400, detail="Nome de arquivo inválido")
 
-    path = (CHARTS_DIR / safe_name)
+    path = (CHARTS_DIR / filename)
     # garante que não está fora do diretório
     _ensure_within_dir(path, CHARTS_DIR)
 
     if not path.exists():
         raise HTTPException(status_code=404, detail="Gráfico não encontrado")
 
-    return FileResponse(path, media_type="image/png", filename=safe_name)
+    # nome = hash do pedido: o conteúdo nunca muda, o navegador pode guardar indefinidamente
+    return FileResponse(
+        path, media_type="image/png", filename=filename,
+        headers={"Cache-Control": "private, max-age=31536000, immutable"},
+    )
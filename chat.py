@@ -4,17 +4,29 @@ import io
 import base64
 import logging
 import asyncio
-from typing import Optional, List, Dict, Any
+import shutil
+import queue
+import pickle
+import hashlib
+import sqlite3
+import threading
+import weakref
+from typing import Optional, List, Dict, Any, Tuple, FrozenSet
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
+import orjson
+import numpy as np
 import pandas as pd
 import matplotlib
 matplotlib.use("Agg")  # headless-friendly
-import matplotlib.pyplot as plt
+from matplotlib.artist import setp
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-from fastapi import APIRouter, Depends, HTTPException, Body, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Body, UploadFile, File, Request, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 
 # auth dependency (must return payload dict with 'sub')
@@ -32,10 +44,26 @@ EXCEL_UPLOAD_DIR = Path(os.getenv("EXCEL_UPLOAD_DIR", "uploads/excel")).resolve(
 CHARTS_DIR = Path(os.getenv("CHARTS_DIR", "uploads/charts")).resolve()
 MAX_EXCEL_SIZE = int(os.getenv("MAX_EXCEL_SIZE", 20 * 1024 * 1024))  # 20 MB default
 CACHE_EXPIRY_MINUTES = int(os.getenv("CACHE_EXPIRY_MINUTES", 30))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 256))
+CHAT_HISTORY_MAX = int(os.getenv("CHAT_HISTORY_MAX", 500))  # messages kept per user
+CHAT_STATE_DB = Path(os.getenv("CHAT_STATE_DB", "uploads/chat_state.db")).resolve()
 
 EXCEL_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 CHARTS_DIR.mkdir(parents=True, exist_ok=True)
 
+# calamine (Rust) parses xlsx/xls much faster and leaner than openpyxl/xlrd; optional
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE: Optional[str] = "calamine"
+except ImportError:  # pragma: no cover - optional dependency
+    EXCEL_ENGINE = None
+
+VALID_CHAT_TYPES: FrozenSet[str] = frozenset({
+    "novos_clientes", "queijo_reino", "nao_cobertos_clientes",
+    "nao_cobertos_fornecedor", "msl_danone", "msl_otg", "msl_mini", "msl_super"
+})
+VALID_CHAT_TYPES_MSG = ", ".join(sorted(VALID_CHAT_TYPES))
+
 # ========== Models ==========
 class ChatMessage(BaseModel):
     chat_type: str
@@ -55,6 +83,7 @@ class GraphRequest(BaseModel):
     title: str
     data_column: str
     category_column: Optional[str] = None
+    dpi: int = Field(96, ge=50, le=300)
 
 class WhatsAppMessage(BaseModel):
     phone_number: str
@@ -63,11 +92,141 @@ class WhatsAppMessage(BaseModel):
 
 # ========== Globals (thread-safe primitives where needed) ==========
 _cache_data: Dict[str, Dict[str, Any]] = defaultdict(dict)
-_cache_lock: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+# a lock lives only while some request holds or waits on it
+_cache_lock: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
 _last_update: Dict[str, datetime] = defaultdict(lambda: datetime.min.replace(tzinfo=timezone.utc))
-_chat_history: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
-_excel_files: Dict[str, Dict[str, Any]] = {}  # filename -> {path, owner, uploaded_at}
 _trash_bin: List[Dict[str, Any]] = []
+# parsed workbooks shared by all chat_types; key = (path, st_mtime_ns, st_size, column spec or None)
+_df_cache: Dict[Tuple[str, int, int, Optional[str]], pd.DataFrame] = {}
+# _load_dataframe runs in worker threads: guards _df_cache mutation/iteration (parsing stays outside)
+_df_cache_lock = threading.Lock()
+
+# chat_types that only read one of these columns cache just that column
+VALUE_COLUMN_CANDIDATES = ("Valor", "valor", "Vendas", "vendas", "amount")
+COLUMN_SPECS: Dict[str, Tuple[str, ...]] = {"queijo_reino": VALUE_COLUMN_CANDIDATES}
+
+def _get_lock(key: str) -> asyncio.Lock:
+    lock = _cache_lock.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _cache_lock[key] = lock
+    return lock
+
+# ========== JSON (orjson; numeric columns go out as NumPy arrays) ==========
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+
+def _orjson_default(obj: Any) -> Any:
+    if isinstance(obj, np.ndarray):
+        # object/str arrays are not handled natively
+        return obj.tolist()
+    if obj is pd.NaT:
+        return None
+    if isinstance(obj, (pd.Timestamp, pd.Timedelta)):
+        return obj.isoformat()
+    raise TypeError
+
+def _dumps(data: Any) -> bytes:
+    return orjson.dumps(data, default=_orjson_default, option=ORJSON_OPTIONS)
+
+class ChatJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
+
+# ========== Persistent state (SQLite, WAL) ==========
+class ChatStateStore:
+    """Chat history, uploaded-file metadata and a copy of the chat caches, on disk instead of in process memory."""
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._lock = threading.Lock()  # one shared connection, used from worker threads
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    chat_type TEXT NOT NULL,
+                    user_message TEXT NOT NULL,
+                    ai_response TEXT NOT NULL,
+                    ts TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (user_id, id);
+                CREATE TABLE IF NOT EXISTS excel_files (
+                    filename TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    uploaded_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_excel_files_uploaded ON excel_files (uploaded_at);
+                CREATE TABLE IF NOT EXISTS chat_cache (
+                    chat_type TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                );
+            """)
+
+    def add_history(self, user_id: str, chat_type: str, user_message: str, ai_response: str, ts: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO chat_history (user_id, chat_type, user_message, ai_response, ts) VALUES (?, ?, ?, ?, ?)",
+                (user_id, chat_type, user_message, ai_response, ts),
+            )
+            # keep only the newest CHAT_HISTORY_MAX rows for this user (index-backed range delete)
+            self._conn.execute(
+                "DELETE FROM chat_history WHERE user_id = ? AND id <= "
+                "(SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (user_id, user_id, CHAT_HISTORY_MAX),
+            )
+
+    def get_history(self, user_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_type, user_message, ai_response, ts FROM ("
+                "SELECT id, chat_type, user_message, ai_response, ts FROM chat_history "
+                "WHERE user_id = ? ORDER BY id DESC LIMIT ?) ORDER BY id",
+                (user_id, CHAT_HISTORY_MAX),
+            ).fetchall()
+        return [{"chat_type": r[0], "user_message": r[1], "ai_response": r[2], "timestamp": r[3]} for r in rows]
+
+    def put_excel_file(self, filename: str, path: str, owner: str, uploaded_at: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO excel_files (filename, path, owner, uploaded_at) VALUES (?, ?, ?, ?)",
+                (filename, path, owner, uploaded_at),
+            )
+
+    def get_excel_file(self, filename: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, owner, uploaded_at FROM excel_files WHERE filename = ?", (filename,)
+            ).fetchone()
+        return {"path": row[0], "owner": row[1], "uploaded_at": row[2]} if row else None
+
+    def save_cache(self, chat_type: str, data: Dict[str, Any], updated_at: str):
+        payload = _dumps(data).decode()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_cache (chat_type, data, updated_at) VALUES (?, ?, ?)",
+                (chat_type, payload, updated_at),
+            )
+
+    def delete_cache(self, chat_type: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chat_cache WHERE chat_type = ?", (chat_type,))
+
+    def load_cache(self) -> Dict[str, Tuple[Dict[str, Any], str]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_type, data, updated_at FROM chat_cache").fetchall()
+        return {r[0]: (orjson.loads(r[1]), r[2]) for r in rows}
+
+_state = ChatStateStore(CHAT_STATE_DB)
+
+# warm the in-memory chat caches from the last run
+for _ct, (_data, _updated_at) in _state.load_cache().items():
+    _cache_data[_ct] = _data
+    _last_update[_ct] = datetime.fromisoformat(_updated_at)
 
 # ========== Utilities ==========
 _filename_re = re.compile(r"[^A-Za-z0-9._-]")
@@ -86,31 +245,106 @@ def _ensure_within_dir(path: Path, parent: Path):
     if parent_res not in p.parents and p != parent_res:
         raise HTTPException(status_code=403, detail="Acesso negado")
 
-async def _save_bytes_to_file(path: Path, data: bytes):
-    # Async-safe small helper
-    path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = path.with_suffix(path.suffix + ".part")
-    try:
-        def write_file():
-            with open(tmp, "wb") as f:
-                f.write(data)
-        await asyncio.to_thread(write_file)
-        tmp.replace(path)
-    finally:
-        if tmp.exists():
-            try:
-                tmp.unlink()
-            except Exception:
-                pass
+# leading bytes per extension: xlsx is a zip container, xls an OLE2 compound file
+_EXCEL_MAGIC = {
+    ".xlsx": b"PK\x03\x04",
+    ".xls": b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",
+}
+
+def _matches_signature(ext: str, head: bytes) -> bool:
+    magic = _EXCEL_MAGIC.get(ext)
+    if magic is not None:
+        return head.startswith(magic)
+    # csv: plain text, so no NUL bytes at the start
+    return b"\x00" not in head[:1024]
+
+def _copy_upload(src: Any, dest: Path, size: int):
+    """Copy the spooled upload to `dest`; zero-copy os.sendfile when it already spilled to a real file."""
+    # SpooledTemporaryFile internals (private, checked defensively): `_rolled` becomes True once the
+    # body exceeds max_size and moves from a BytesIO into an on-disk temp file held in `_file`
+    if hasattr(os, "sendfile") and getattr(src, "_rolled", False):
+        in_fd = src._file.fileno()
+        with open(dest, "wb") as out:
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(out.fileno(), in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        if offset < size:
+            # source shrank/truncated under us: never keep a partial upload
+            raise OSError(f"short copy: {offset} of {size} bytes")
+        return
+    src.seek(0)
+    with open(dest, "wb") as out:
+        shutil.copyfileobj(src, out, 1024 * 1024)
+
+def _store_upload(src: Any, dest: Path, ext: str):
+    # the body is already spooled by the multipart parser: size is a seek, not a read loop
+    src.seek(0, os.SEEK_END)
+    size = src.tell()
+    if size > MAX_EXCEL_SIZE:
+        raise HTTPException(status_code=413, detail="Arquivo excede limite")
+    src.seek(0)
+    head = src.read(1024)
+    # reject mislabeled/garbage files before copying anything
+    if head and not _matches_signature(ext, head):
+        raise HTTPException(status_code=400, detail="Conteúdo do arquivo não corresponde à extensão")
+    _copy_upload(src, dest, size)
 
 def _read_excel_safe(path: Path) -> pd.DataFrame:
     try:
-        df = pd.read_excel(path)  # type: ignore
-        return df
+        if path.suffix.lower() == ".csv":
+            return pd.read_csv(path)  # type: ignore
+        return pd.read_excel(path, engine=EXCEL_ENGINE)  # type: ignore
     except Exception as e:
         logger.exception("Erro lendo excel %s: %s", path, e)
         raise HTTPException(status_code=400, detail="Falha ao ler arquivo Excel")
 
+def _file_version(path: Path) -> Tuple[str, int, int]:
+    st = path.stat()
+    return (str(path), st.st_mtime_ns, st.st_size)
+
+def _select_spec(df: pd.DataFrame, candidates: Tuple[str, ...]) -> pd.DataFrame:
+    # first candidate present wins; no match keeps the whole frame (same as an unspecced load)
+    for candidate in candidates:
+        if candidate in df.columns:
+            return df[[candidate]].copy()
+    return df
+
+def _load_dataframe(path: Path, chat_type: Optional[str] = None) -> pd.DataFrame:
+    """Parse the workbook once per file version; later calls (any chat_type) reuse it."""
+    version = _file_version(path)
+    full = _df_cache.get(version + (None,))
+    if full is not None:
+        return full
+    spec = chat_type if chat_type in COLUMN_SPECS else None
+    key = version + (spec,)
+    df = _df_cache.get(key)
+    if df is None:
+        # one parse, then keep the column: a header probe (nrows=0) still decodes the whole sheet under calamine
+        df = _read_excel_safe(path)
+        if spec:
+            df = _select_spec(df, COLUMN_SPECS[spec])
+        with _df_cache_lock:
+            # a new version replaces older ones of the same file
+            for old in [k for k in list(_df_cache) if k[0] == version[0] and k[:3] != version]:
+                _df_cache.pop(old, None)
+            _df_cache[key] = df
+    return df
+
+def _evict_stale_dataframes():
+    with _df_cache_lock:
+        keys = list(_df_cache)
+    for key in keys:
+        try:
+            current = _file_version(Path(key[0]))
+        except OSError:
+            current = None
+        if current != key[:3]:
+            with _df_cache_lock:
+                _df_cache.pop(key, None)
+
 def _validate_dataframe(df: pd.DataFrame) -> bool:
     return not df.empty and len(df.columns) > 0
 
@@ -118,23 +352,39 @@ def _validate_dataframe(df: pd.DataFrame) -> bool:
 class AILearningEngine:
     def __init__(self):
         self.patterns: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        # chat_type -> token -> positions in patterns[chat_type]; only patterns sharing a token can match
+        self._token_index: Dict[str, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(list))
 
     def learn_pattern(self, chat_type: str, user_input: str, ai_response: str):
-        self.patterns[chat_type].append({
-            "input": user_input.lower(),
+        text = user_input.lower()
+        entry = {
+            "input": text,
+            "tokens": frozenset(text.split()),
             "response": ai_response,
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "frequency": 1
-        })
+        }
+        bucket = self.patterns[chat_type]
+        pos = len(bucket)
+        bucket.append(entry)
+        index = self._token_index[chat_type]
+        for tok in entry["tokens"]:
+            index[tok].append(pos)
 
     def find_similar_pattern(self, chat_type: str, user_input: str) -> Optional[str]:
-        s = user_input.lower().split()
+        index = self._token_index.get(chat_type)
+        if not index:
+            return None
+        qtok = frozenset(user_input.lower().split())
+        patterns = self.patterns[chat_type]
+        # sorted keeps insertion order, so ties resolve as before
+        candidates = sorted({pos for tok in qtok for pos in index.get(tok, ())})
         best = None
         best_score = 0.0
-        for p in self.patterns.get(chat_type, []):
-            words2 = p["input"].split()
-            inter = len(set(s).intersection(words2))
-            union = len(set(s).union(words2)) or 1
+        for pos in candidates:
+            p = patterns[pos]
+            inter = len(qtok & p["tokens"])
+            union = len(qtok | p["tokens"]) or 1
             score = inter / union
             if score > best_score:
                 best_score = score
@@ -163,15 +413,22 @@ class AILearningEngine:
 ai_engine = AILearningEngine()
 
 # ========== Excel processing ==========
+def _columnar(df: pd.DataFrame) -> Dict[str, Any]:
+    # one array per column instead of one dict per row; numeric columns stay NumPy (orjson encodes them natively)
+    return {
+        "columns": [str(c) for c in df.columns],
+        "values": [s.to_numpy() if s.dtype.kind in "biuf" else s.tolist() for _, s in df.items()],
+    }
+
 class AdvancedExcelReader:
     @staticmethod
     def process_data(df: pd.DataFrame, chat_type: str) -> Dict[str, Any]:
         processed: Dict[str, Any] = {"total_rows": len(df), "columns": list(df.columns), "summary": {}}
         if chat_type == "novos_clientes":
-            processed["summary"]["clientes"] = df.to_dict("records")  # type: ignore
+            processed["summary"]["clientes"] = _columnar(df)
         elif chat_type == "queijo_reino":
             # try flexible column names
-            for candidate in ("Valor", "valor", "Vendas", "vendas", "amount"):
+            for candidate in VALUE_COLUMN_CANDIDATES:
                 if candidate in df.columns:
                     col: pd.Series[float] = pd.to_numeric(df[candidate], errors="coerce").fillna(0)  # type: ignore
                     processed["summary"]["vendas_total"] = float(col.sum())
@@ -179,13 +436,36 @@ class AdvancedExcelReader:
                     processed["summary"]["max"] = float(col.max())
                     break
         elif "nao_cobertos" in chat_type:
-            processed["summary"]["lista"] = df.to_dict("records")  # type: ignore
+            processed["summary"]["lista"] = _columnar(df)
             processed["summary"]["total_nao_cobertos"] = len(df)
         else:
-            processed["summary"]["dados"] = df.to_dict("records")  # type: ignore[assignment]
+            processed["summary"]["dados"] = _columnar(df)
         return processed
 
 # ========== Chart generation (returns base64 data URL) ==========
+# Figures are pooled and reused (cleared between renders); the OO Figure/Agg API
+# avoids pyplot's global state, which is not safe across threadpool workers.
+_fig_pool: "queue.SimpleQueue[Figure]" = queue.SimpleQueue()
+
+def _acquire_figure(figsize: tuple) -> Figure:
+    try:
+        fig = _fig_pool.get_nowait()
+    except queue.Empty:
+        # constrained layout is solved while drawing; no separate tight_layout pass
+        fig = Figure(layout="constrained")
+        FigureCanvasAgg(fig)
+    fig.set_size_inches(*figsize)
+    return fig
+
+def _release_figure(fig: Figure) -> None:
+    fig.clear()
+    _fig_pool.put(fig)
+
+def _export_figure(fig: Figure, dpi: int) -> str:
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=dpi)  # type: ignore
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
+
 class ChartGenerator:
     @staticmethod
     def _normalize_data_for_plot(raw: Dict[str, Any], data_column: str) -> Dict[str, float]:
@@ -197,10 +477,15 @@ class ChartGenerator:
                 out[str(k)] = float(v or 0.0)
         else:
             # try to pick entries having data_column
-            if isinstance(raw.get("lista"), list):
-                for r in raw["lista"]:
-                    cat = str(r.get(data_column, "Unknown"))
-                    out[cat] = out.get(cat, 0.0) + float(r.get(data_column, 0) or 0.0)
+            lista = raw.get("lista")
+            if isinstance(lista, dict) and "columns" in lista:
+                cols: List[str] = lista["columns"]
+                if data_column in cols:
+                    col = pd.Series(lista["values"][cols.index(data_column)])
+                    values = pd.to_numeric(col, errors="coerce").fillna(0.0)
+                    out.update(values.groupby(col.astype(str), sort=False).sum().to_dict())
+                elif lista["values"] and len(lista["values"][0]):
+                    out["Unknown"] = 0.0
             else:
                 # fallback: convert numeric-like values
                 for k, v in raw.items():
@@ -211,38 +496,33 @@ class ChartGenerator:
         return out or {"empty": 0.0}
 
     @staticmethod
-    def generate_column_chart(summary: Dict[str, Any], title: str, x_label: str, y_label: str) -> str:
+    def generate_column_chart(summary: Dict[str, Any], title: str, x_label: str, y_label: str, dpi: int = 96) -> str:
         data = ChartGenerator._normalize_data_for_plot(summary, y_label)
         categories = list(data.keys())
         values = list(data.values())
 
-        from matplotlib.figure import Figure
         from matplotlib.axes import Axes
         from matplotlib.container import BarContainer
-        fig: Figure
-        ax: Axes
-        fig, ax = plt.subplots(figsize=(10, 6), squeeze=True)  # type: ignore
-        bars: BarContainer = ax.bar(categories, values)  # type: ignore
-        ax.set_title(str(title))  # type: ignore
-        ax.set_xlabel(str(x_label))  # type: ignore
-        ax.set_ylabel(str(y_label))  # type: ignore
-        ax.grid(axis="y", linestyle="--", alpha=0.3)  # type: ignore
-        for bar in bars:  # type: ignore
-            x_pos = float(bar.get_x()) + float(bar.get_width()) / 2  # type: ignore
-            y_pos = float(bar.get_height())  # type: ignore
-            ax.text(x_pos, y_pos,  # type: ignore
-                    f"{y_pos:.2f}", ha="center", va="bottom", fontsize=9)
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, ha="right")  # type: ignore
-        buf = io.BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf, format="png", dpi=150)  # type: ignore
-        buf.seek(0)
-        data_url = "data:image/png;base64," + base64.b64encode(buf.read()).decode()
-        plt.close(fig)
-        return data_url
+        fig = _acquire_figure((10, 6))
+        try:
+            ax: Axes = fig.add_subplot(111)
+            bars: BarContainer = ax.bar(categories, values)  # type: ignore
+            ax.set_title(str(title))  # type: ignore
+            ax.set_xlabel(str(x_label))  # type: ignore
+            ax.set_ylabel(str(y_label))  # type: ignore
+            ax.grid(axis="y", linestyle="--", alpha=0.3)  # type: ignore
+            for bar in bars:  # type: ignore
+                x_pos = float(bar.get_x()) + float(bar.get_width()) / 2  # type: ignore
+                y_pos = float(bar.get_height())  # type: ignore
+                ax.text(x_pos, y_pos,  # type: ignore
+                        f"{y_pos:.2f}", ha="center", va="bottom", fontsize=9)
+            setp(ax.xaxis.get_majorticklabels(), rotation=45, ha="right")  # type: ignore
+            return _export_figure(fig, dpi)
+        finally:
+            _release_figure(fig)
 
     @staticmethod
-    def generate_pie_chart(summary: Dict[str, Any], title: str) -> str:
+    def generate_pie_chart(summary: Dict[str, Any], title: str, dpi: int = 96) -> str:
         data = ChartGenerator._normalize_data_for_plot(summary, "")
         labels = list(data.keys())
         sizes = list(data.values())
@@ -250,16 +530,32 @@ class ChartGenerator:
             # avoid zero division in pie
             sizes = [1 for _ in sizes] if sizes else [1]
             labels = labels or ["empty"]
-        fig, ax = plt.subplots(figsize=(8, 8), squeeze=True)  # type: ignore
-        ax.pie(sizes, labels=labels, autopct="%1.1f%%", startangle=90)
-        ax.set_title(str(title))  # type: ignore
-        buf = io.BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf, format="png", dpi=150)  # type: ignore
-        buf.seek(0)
-        data_url = "data:image/png;base64," + base64.b64encode(buf.read()).decode()
-        plt.close(fig)
-        return data_url
+        fig = _acquire_figure((8, 8))
+        try:
+            ax = fig.add_subplot(111)
+            ax.pie(sizes, labels=labels, autopct="%1.1f%%", startangle=90)
+            ax.set_title(str(title))  # type: ignore
+            return _export_figure(fig, dpi)
+        finally:
+            _release_figure(fig)
+
+# rendered charts by hash of (summary, title, type, columns); LRU, cleared when chat data changes
+_chart_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def _chart_cache_key(*parts: Any) -> str:
+    return hashlib.blake2b(pickle.dumps(parts, protocol=pickle.HIGHEST_PROTOCOL), digest_size=16).hexdigest()
+
+def _chart_cache_get(key: str) -> Optional[str]:
+    data_url = _chart_cache.get(key)
+    if data_url is not None:
+        _chart_cache.move_to_end(key)
+    return data_url
+
+def _chart_cache_put(key: str, data_url: str):
+    _chart_cache[key] = data_url
+    _chart_cache.move_to_end(key)
+    while len(_chart_cache) > CHART_CACHE_SIZE:
+        _chart_cache.popitem(last=False)
 
 chart_gen = ChartGenerator()
 excel_reader = AdvancedExcelReader()
@@ -275,27 +571,33 @@ class WhatsAppIntegration:
 def add_to_trash(file_name: str, file_path: str):
     _trash_bin.append({"file_name": file_name, "file_path": file_path, "deleted_at": datetime.now(timezone.utc).isoformat()})
 
-def empty_trash():
-    for item in list(_trash_bin):
-        try:
-            p = Path(item["file_path"])
-            if p.exists():
-                p.unlink()
-            _trash_bin.remove(item)
-        except Exception:
-            logger.exception("Erro ao esvaziar lixeira item %s", item.get("file_name"))
+async def empty_trash():
+    # drain first (pop from the end: O(1) per item), then unlink concurrently off the event loop
+    drained: List[Dict[str, Any]] = []
+    while _trash_bin:
+        drained.append(_trash_bin.pop())
+    results = await asyncio.gather(
+        *(asyncio.to_thread(Path(item["file_path"]).unlink, missing_ok=True) for item in drained),
+        return_exceptions=True,
+    )
+    for item, result in zip(drained, results):
+        if isinstance(result, BaseException):
+            logger.error("Erro ao esvaziar lixeira item %s: %s", item.get("file_name"), result)
 
 # ========== Background cache refresh (optional to run externally) ==========
 async def auto_update_cache_loop():
     while True:
         try:
             await asyncio.sleep(CACHE_EXPIRY_MINUTES * 60)
-            cutoff = datetime.now(timezone.utc) - timedelta(minutes=CACHE_EXPIRY_MINUTES)
+            now = datetime.now(timezone.utc)
+            cutoff = now - timedelta(minutes=CACHE_EXPIRY_MINUTES)
             for ct, updated in list(_last_update.items()):
                 if updated < cutoff:
                     _cache_data[ct].clear()
-                    _last_update[ct] = datetime.now(timezone.utc)
-            empty_trash()
+                    _last_update[ct] = now
+                    await asyncio.to_thread(_state.delete_cache, ct)
+            _evict_stale_dataframes()
+            await empty_trash()
         except asyncio.CancelledError:
             break
         except Exception:
@@ -307,36 +609,40 @@ router = APIRouter()
 @router.post("/message", response_model=ChatResponse)
 async def send_chat_message(chat_msg: ChatMessage = Body(...), payload: Dict[str, str] = Depends(verify_token)):
     user_id: str = payload.get("sub", "")
-    valid_types = {
-        "novos_clientes", "queijo_reino", "nao_cobertos_clientes",
-        "nao_cobertos_fornecedor", "msl_danone", "msl_otg", "msl_mini", "msl_super"
-    }
-    if chat_msg.chat_type not in valid_types:
-        raise HTTPException(status_code=400, detail=f"Tipo inválido. Use: {', '.join(sorted(valid_types))}")
+    # one timestamp per request: cache, history and response all agree
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    if chat_msg.chat_type not in VALID_CHAT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Tipo inválido. Use: {VALID_CHAT_TYPES_MSG}")
 
     # load from cache or process uploaded excel
-    async with _cache_lock[chat_msg.chat_type]:
+    async with _get_lock(chat_msg.chat_type):
         if not _cache_data.get(chat_msg.chat_type):
             if chat_msg.file_name:
-                meta = _excel_files.get(chat_msg.file_name)
+                meta = await asyncio.to_thread(_state.get_excel_file, chat_msg.file_name)
                 if not meta:
                     raise HTTPException(status_code=404, detail="Arquivo Excel não encontrado")
                 file_path = Path(meta["path"])
                 _ensure_within_dir(file_path, EXCEL_UPLOAD_DIR)
-                df = _read_excel_safe(file_path)
+                try:
+                    df = await asyncio.to_thread(_load_dataframe, file_path, chat_msg.chat_type)
+                except FileNotFoundError:
+                    raise HTTPException(status_code=404, detail="Arquivo Excel não encontrado")
                 if not _validate_dataframe(df):
                     raise HTTPException(status_code=400, detail="Dados do Excel inválidos")
                 processed = excel_reader.process_data(df, chat_msg.chat_type)
                 _cache_data[chat_msg.chat_type] = processed
-                _last_update[chat_msg.chat_type] = datetime.now(timezone.utc)
+                _last_update[chat_msg.chat_type] = now
+                await asyncio.to_thread(_state.save_cache, chat_msg.chat_type, processed, now_iso)
 
     data_for_ai = _cache_data.get(chat_msg.chat_type, {})
     ai_resp = ai_engine.generate_response(chat_msg.chat_type, chat_msg.message, data_for_ai)
 
     # store history
-    _chat_history[user_id].append({"chat_type": chat_msg.chat_type, "user_message": chat_msg.message, "ai_response": ai_resp, "timestamp": datetime.now(timezone.utc).isoformat()})
+    await asyncio.to_thread(_state.add_history, user_id, chat_msg.chat_type, chat_msg.message, ai_resp, now_iso)
 
-    return ChatResponse(status="success", message=ai_resp, data=data_for_ai, timestamp=datetime.now(timezone.utc).isoformat())
+    # returned as a Response so FastAPI skips jsonable_encoder; ChatResponse still documents the shape
+    return ChatJSONResponse({"status": "success", "message": ai_resp, "data": data_for_ai, "chart_url": None, "timestamp": now_iso})
 
 @router.post("/upload-excel")
 async def upload_excel_file(file: UploadFile = File(...), chat_type: Optional[str] = None, payload: Dict[str, str] = Depends(verify_token)) -> Dict[str, Any]:
@@ -348,36 +654,33 @@ async def upload_excel_file(file: UploadFile = File(...), chat_type: Optional[st
     dest = EXCEL_UPLOAD_DIR / fname
     _ensure_within_dir(dest, EXCEL_UPLOAD_DIR)
 
-    # stream-save in chunks
-    total = 0
-    chunks: List[bytes] = []
+    # copy the spooled upload to a .part file in the kernel (sendfile) when possible
+    ext = Path(file.filename).suffix.lower()
+    tmp = dest.with_suffix(dest.suffix + ".part")
     try:
-        while True:
-            chunk = await file.read(1024 * 1024)
-            if not chunk:
-                break
-            total += len(chunk)
-            if total > MAX_EXCEL_SIZE:
-                raise HTTPException(status_code=413, detail="Arquivo excede limite")
-            chunks.append(chunk)
-        data = b"".join(chunks)
-        await _save_bytes_to_file(dest, data)
+        await asyncio.to_thread(_store_upload, file.file, tmp, ext)
+        tmp.replace(dest)
     except HTTPException:
         raise
     except Exception as e:
         logger.exception("Erro no upload-excel: %s", e)
         raise HTTPException(status_code=500, detail="Falha no upload")
+    finally:
+        tmp.unlink(missing_ok=True)
 
     # store metadata and clear cache for that chat_type
-    _excel_files[file.filename] = {"path": str(dest), "owner": user_id, "uploaded_at": datetime.now(timezone.utc).isoformat()}
+    now = datetime.now(timezone.utc)
+    await asyncio.to_thread(_state.put_excel_file, file.filename, str(dest), user_id, now.isoformat())
     if chat_type:
         _cache_data.pop(chat_type, None)
-        _last_update[chat_type] = datetime.now(timezone.utc)
+        _last_update[chat_type] = now
+        await asyncio.to_thread(_state.delete_cache, chat_type)
+    _chart_cache.clear()
 
     return {"status": "success", "message": "Arquivo enviado", "file_name": file.filename, "file_path": str(dest)}
 
 @router.post("/generate-chart")
-async def generate_chart(graph_req: GraphRequest = Body(...), payload: Dict[str, str] = Depends(verify_token)):
+async def generate_chart(request: Request, response: Response, graph_req: GraphRequest = Body(...), payload: Dict[str, str] = Depends(verify_token)):
     if graph_req.chat_type not in _cache_data:
         raise HTTPException(status_code=400, detail="Dados não carregados para esse tipo de chat")
 
@@ -385,13 +688,32 @@ async def generate_chart(graph_req: GraphRequest = Body(...), payload: Dict[str,
     if not summary:
         raise HTTPException(status_code=400, detail="Dados insuficientes para gráfico")
 
-    if graph_req.graph_type.lower() in ("column", "bar"):
-        data_url = chart_gen.generate_column_chart(summary, graph_req.title, graph_req.category_column or "Categoria", graph_req.data_column)
-    elif graph_req.graph_type.lower() in ("pizza", "pie"):
-        data_url = chart_gen.generate_pie_chart(summary, graph_req.title)
+    graph_type = graph_req.graph_type.lower()
+    if graph_type in ("column", "bar"):
+        graph_type = "column"
+    elif graph_type in ("pizza", "pie"):
+        graph_type = "pie"
     else:
         raise HTTPException(status_code=400, detail="Tipo de gráfico inválido")
 
+    # same data + same request -> reuse the rendered chart, skipping matplotlib
+    key = _chart_cache_key(summary, graph_req.title, graph_type, graph_req.category_column, graph_req.data_column, graph_req.dpi)
+    # the key fully determines the chart: clients revalidate with If-None-Match and skip the body
+    etag = f'W/"{key}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [v.strip() for v in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    data_url = _chart_cache_get(key)
+    if data_url is None:
+        # matplotlib rendering is CPU-bound: keep it off the event loop
+        if graph_type == "column":
+            data_url = await asyncio.to_thread(chart_gen.generate_column_chart, summary, graph_req.title, graph_req.category_column or "Categoria", graph_req.data_column, graph_req.dpi)
+        else:
+            data_url = await asyncio.to_thread(chart_gen.generate_pie_chart, summary, graph_req.title, graph_req.dpi)
+        _chart_cache_put(key, data_url)
+
     return {"status": "success", "message": "Gráfico gerado", "chart_url": data_url, "timestamp": datetime.now(timezone.utc).isoformat()}
 
 @router.post("/send-whatsapp")
@@ -405,7 +727,7 @@ async def get_trash(payload: Dict[str, str] = Depends(verify_token)) -> Dict[str
 
 @router.delete("/trash")
 async def empty_trash_endpoint(payload: Dict[str, str] = Depends(verify_token)):
-    empty_trash()
+    await empty_trash()
     return {"status": "success", "message": "Lixeira esvaziada"}
 
 @router.get("/history")
@@ -413,11 +735,13 @@ async def get_chat_history(payload: Dict[str, str] = Depends(verify_token)) -> D
     user_id: str = payload.get("sub", "")
     if not user_id:
         return {"status": "error", "message": "Usuário não identificado", "history": [], "total": 0}
-    history = _chat_history.get(user_id, [])
+    history = await asyncio.to_thread(_state.get_history, user_id)
     return {"status": "success", "history": history, "total": len(history)}
 
 @router.post("/clear-cache/{chat_type}")
 async def clear_cache(chat_type: str, payload: Dict[str, str] = Depends(verify_token)):
     _cache_data.pop(chat_type, None)
     _last_update[chat_type] = datetime.now(timezone.utc)
+    await asyncio.to_thread(_state.delete_cache, chat_type)
+    _chart_cache.clear()
     return {"status": "success", "message": f"Cache limpo para {chat_type}"}
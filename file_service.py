@@ -10,6 +10,13 @@ import aiofiles
 import pandas as pd
 from fastapi import UploadFile, HTTPException
 
+# calamine (Rust) lê xlsx/xls bem mais rápido que openpyxl/xlrd; usa o padrão do pandas se não instalado
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE: Optional[str] = "calamine"
+except ImportError:  # pragma: no cover - dependência opcional
+    EXCEL_ENGINE = None
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
@@ -75,7 +82,8 @@ def read_table_from_file(path: str, sheet_name: Optional[str] = None, usecols: O
     ext = Path(path).suffix.lower()
     try:
         if ext in [".xls", ".xlsx"]:
-            df = pd.read_excel(path, sheet_name=sheet_name, usecols=usecols)  # type: ignore
+            # sheet_name=None faria o pandas carregar todas as abas; lê só a primeira
+            df = pd.read_excel(path, sheet_name=sheet_name if sheet_name is not None else 0, usecols=usecols, engine=EXCEL_ENGINE)  # type: ignore
             if isinstance(df, dict):
                 df = next(iter(df.values()))
         elif ext == ".csv":
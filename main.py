@@ -2,6 +2,7 @@
 import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 # Importa os módulos de rota
 from auth import router as auth_router, _create_dev_admin_if_missing
@@ -17,7 +18,8 @@ def create_app() -> FastAPI:
     app = FastAPI(
         title="Sistema de Indexação com Autenticação JWT",
         version="2.0.0",
-        description="API robusta com login seguro, upload de arquivos e indexação."
+        description="API robusta com login seguro, upload de arquivos e indexação.",
+        default_response_class=ORJSONResponse,
     )
 
     # === CORS - Configuração para produção e desenvolvimento ===